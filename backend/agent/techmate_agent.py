@@ -4,15 +4,19 @@ import os
 import re
 import json
 import logging
-from typing import List, Optional, Literal
+import asyncio
+from typing import List, Optional, Literal, Tuple
 
+import numpy as np
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 import google.generativeai as genai
 from tavily import AsyncTavilyClient
+from rank_bm25 import BM25Okapi
 
 # Import our Object-Oriented Vector Store
 from backend.database.vector_store import VectorStore
+from backend.database.cache_manager import SemanticCache
 
 # --------------------------- 1) Config & Logging ---------------------------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -29,8 +33,27 @@ genai.configure(api_key=GEMINI_API_KEY)
 MODEL_NAME = "gemini-2.5-flash"
 tavily_client = AsyncTavilyClient(api_key=TAVILY_API_KEY)
 
-# Initialize our Vector DB instance
-vector_store = VectorStore(index_path="data/faiss.index", chunks_path="data/faiss_chunks.json")
+# Initialize our Vector DB instance. The binary index uses its own files: the two formats
+# cannot read each other, and sharing paths would overwrite the saved corpus when switching.
+if os.getenv("TECHMATE_BINARY_INDEX", "0") == "1":
+    vector_store = VectorStore(
+        index_path="data/faiss_binary.index",
+        chunks_path="data/faiss_binary_chunks.json",
+        sources_path="data/faiss_binary_sources.json",
+        binary=True,
+    )
+else:
+    vector_store = VectorStore(
+        index_path="data/faiss.index",
+        chunks_path="data/faiss_chunks.json",
+        sources_path="data/faiss_sources.json",
+    )
+
+# Plans for previously answered (or paraphrased) questions, keyed by query embedding
+answer_cache = SemanticCache(
+    encoder=vector_store.encode,
+    db_path="data/answer_cache.db",
+)
 
 # --------------------------- 2) Prompts & Schemas ---------------------------
 TECHMATE_SYSTEM_PROMPT = (
@@ -65,13 +88,50 @@ class TechMateOutput(BaseModel):
     steps: List[Step] = Field(default_factory=list)
     confidence: float = 0.0
 
+# Constant prompt prefix (instructions + schema) is built once instead of per request
+_SCHEMA_JSON = json.dumps(TechMateOutput.model_json_schema(), indent=2)
+_PROMPT_PREFIX = (
+    "Generate a full troubleshooting plan for the user's issue. Output ONLY valid JSON.\n\n"
+    f"JSON Schema:\n{_SCHEMA_JSON}\n\n"
+)
+
 # --------------------------- 3) AI Web Search (Tavily) ---------------------------
+# Only the top few chunks reach Gemini, so very long pages (full docs/forum threads) are truncated
+MAX_PAGE_CHARS = 50_000
+
+_PARAGRAPH_BREAK_RE = re.compile(r"\n{2,}")
+
 def chunk_text_paragraphs(text: str, chunk_size: int = 1000) -> List[str]:
     if not text: return []
-    return [p.strip() for p in re.split(r"\n{2,}", text) if p.strip() and len(p.strip()) > 50]
+    # Strip each paragraph once; anything 50 chars or shorter is navigation/boilerplate
+    paragraphs = (p.strip() for p in _PARAGRAPH_BREAK_RE.split(text))
+    return [p for p in paragraphs if len(p) > 50]
+
+_TOKEN_RE = re.compile(r"\w+")
+# Max chunks per request that get embedded; the rest are pruned by lexical (BM25) relevance
+MAX_CHUNKS_TO_EMBED = 50
+
+def _tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+def prefilter_chunks(query: str, chunks: List[str], top_n: int = MAX_CHUNKS_TO_EMBED) -> List[str]:
+    """Keeps the top_n chunks by BM25 score against the query (in original order) so only those are embedded.
 
-async def fetch_tavily_context(query: str) -> List[str]:
-    """Uses Tavily to search the web and extract clean text from the top results."""
+    Chunks sharing no terms with the query (score 0) are always dropped.
+    """
+    if not chunks:
+        return []
+    scores = BM25Okapi([_tokenize(c) for c in chunks]).get_scores(_tokenize(query))
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > top_n:
+        candidates = np.sort(candidates[np.argpartition(-scores[candidates], top_n)[:top_n]])
+    return [chunks[i] for i in candidates]
+
+async def fetch_tavily_context(query: str) -> Tuple[List[str], List[str]]:
+    """Uses Tavily to search the web and extract clean text from the top results.
+
+    Returns the chunks of pages not yet in the vector store, plus their source keys.
+    """
     try:
         # 'advanced' depth performs deep scraping on the backend, 
         # include_raw_content=True returns the clean scraped text
@@ -82,31 +142,41 @@ async def fetch_tavily_context(query: str) -> List[str]:
             include_raw_content=True
         )
         
-        all_chunks = []
+        all_chunks, new_keys = [], []
         for result in response.get("results", []):
             # Prefer raw_content if available, fallback to the summary snippet
             content = result.get("raw_content") or result.get("content")
-            if content:
-                all_chunks.extend(chunk_text_paragraphs(content))
-        return all_chunks
+            if not content:
+                continue
+            content = content[:MAX_PAGE_CHARS]
+            # Pages already embedded (same URL and text) are retrievable as-is
+            key = vector_store.source_key(result.get("url", ""), content)
+            if vector_store.has_source(key):
+                continue
+            new_keys.append(key)
+            all_chunks.extend(chunk_text_paragraphs(content))
+        # Drop repeated boilerplate (nav bars, cookie notices) shared across pages, keeping order
+        return list(dict.fromkeys(all_chunks)), new_keys
     except Exception as e:
         logger.error(f"Tavily search failed: {e}")
-        return []
+        return [], []
 
 # --------------------------- 4) LLM Generation ---------------------------
+# Shared across requests; neither holds per-conversation state
+gemini_model = genai.GenerativeModel(MODEL_NAME, system_instruction=TECHMATE_SYSTEM_PROMPT)
+GENERATION_CONFIG = genai.GenerationConfig(response_mime_type="application/json", temperature=0.2)
+
 async def ask_gemini_techmate(user_context: dict, page_snippets: List[dict]) -> TechMateOutput:
-    model = genai.GenerativeModel(MODEL_NAME, system_instruction=TECHMATE_SYSTEM_PROMPT)
     prompt_text = (
-        "Generate a full troubleshooting plan for the user's issue. Output ONLY valid JSON.\n\n"
-        f"JSON Schema:\n{json.dumps(TechMateOutput.model_json_schema(), indent=2)}\n\n"
+        _PROMPT_PREFIX +
         f"User context:\n{json.dumps(user_context, indent=2)}\n\n"
         f"Web snippets:\n{json.dumps(page_snippets, indent=2)}"
     )
     
     try:
-        resp = await model.generate_content_async(
+        resp = await gemini_model.generate_content_async(
             {"role": "user", "parts": [{"text": prompt_text}]},
-            generation_config=genai.GenerationConfig(response_mime_type="application/json", temperature=0.2)
+            generation_config=GENERATION_CONFIG
         )
         return TechMateOutput.model_validate_json(resp.text)
     except Exception as e:
@@ -114,16 +184,40 @@ async def ask_gemini_techmate(user_context: dict, page_snippets: List[dict]) ->
         return TechMateOutput(issue_summary=user_context.get("query", "Error"), steps=[])
 
 # --------------------------- 5) Main Agent Logic ---------------------------
-# --------------------------- 5) Main Agent Logic ---------------------------
+# Strong references to fire-and-forget disk writes so they are not garbage-collected mid-flight
+_background_tasks: set = set()
+
+def _run_in_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
 async def techmate_agent(query: str, device: str = "Windows laptop", os_name: str = "Windows") -> TechMateOutput:
     logger.info(f"Starting agent for query: {query}")
+
+    # 0. Reuse a plan generated for the same (or a paraphrased) question
+    cached = await answer_cache.search_async(query, device, os_name)
+    if cached:
+        return TechMateOutput.model_validate(cached)
     
     # 1. Search Web & Get Clean Content (Tavily)
-    all_chunks = await fetch_tavily_context(f"{os_name} {device} {query} troubleshooting fix")
+    all_chunks, source_keys = await fetch_tavily_context(f"{os_name} {device} {query} troubleshooting fix")
+
+    # Embedding dominates CPU time, so only the lexically closest chunks are embedded. Ranking runs
+    # over every chunk of the page, so a repeated query picks the same top chunks, which are then
+    # skipped as already indexed instead of pulling in the next, less relevant ones.
+    # Pruned pages are not marked as indexed, so a different query can still pick up their other chunks.
+    kept_chunks = await asyncio.to_thread(prefilter_chunks, query, all_chunks)
+    if len(kept_chunks) < len(all_chunks):
+        logger.info(f"BM25 prefilter kept {len(kept_chunks)} of {len(all_chunks)} chunks.")
+        all_chunks, source_keys = kept_chunks, []
+    all_chunks = vector_store.unindexed(all_chunks)
 
     # 2. Add to Vector Store (Async)
-    if all_chunks:
-        await vector_store.add_texts_async(all_chunks)
+    if all_chunks or source_keys:
+        await vector_store.add_texts_async(all_chunks, persist=False, source_keys=source_keys)
+        # Persist the grown index while retrieval and Gemini run, instead of before them
+        _run_in_background(vector_store.save_to_disk_async())
 
     # 3. Retrieve & Re-Rank Relevant context
     # Grabs 10 initial chunks, but only gives the top 3 best to Gemini
@@ -138,5 +232,9 @@ async def techmate_agent(query: str, device: str = "Windows laptop", os_name: st
     # 4. Generate Plan
     user_ctx = {"query": query, "device": device, "os": os_name}
     plan = await ask_gemini_techmate(user_ctx, page_snippets)
+
+    # Only cache real plans, not the empty fallback returned on generation errors
+    if plan.steps:
+        _run_in_background(answer_cache.add_async(query, device, os_name, plan.model_dump()))
     
     return plan
\ No newline at end of file
@@ -0,0 +1,143 @@
+# backend/database/cache_manager.py
+import os
+import json
+import logging
+import asyncio
+import sqlite3
+import threading
+import numpy as np
+import faiss
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger("techmate.cache_manager")
+
+class SemanticCache:
+    """Caches generated plans by query embedding so paraphrased questions reuse a previous answer.
+
+    Rows live in SQLite (WAL mode), one per (query, device, os), so a miss costs a single
+    INSERT instead of rewriting a cache file. Exact repeats are answered straight from SQLite
+    without embedding the query. Only the query vectors and row ids are held in memory; answers
+    are read back by rowid on a hit.
+    """
+
+    def __init__(self, encoder: Callable[[List[str]], np.ndarray],
+                 db_path: str = "data/answer_cache.db",
+                 threshold: float = 0.93, candidates: int = 5):
+        self.encoder = encoder
+        self.db_path = db_path
+        self.threshold = threshold
+        self.candidates = candidates
+        self.index = None
+        # (rowid, device, os) per index row, in FAISS id order
+        self.entries: List[Tuple[int, str, str]] = []
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS answer_cache (
+                    query TEXT,
+                    device TEXT,
+                    os TEXT,
+                    answer TEXT,
+                    embedding BLOB,
+                    PRIMARY KEY (query, device, os)
+                )
+            ''')
+
+    def _embed(self, query: str) -> np.ndarray:
+        q_emb = np.array(self.encoder([query]), dtype="float32")
+        faiss.normalize_L2(q_emb)
+        return q_emb
+
+    def _ensure_loaded(self, dim: int):
+        """Builds the inner-product index from SQLite on first use (dim comes from the encoder)."""
+        if self.index is not None:
+            return
+        self.index = faiss.IndexFlatIP(dim)
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                rows = conn.execute(
+                    'SELECT rowid, device, os, embedding FROM answer_cache ORDER BY rowid'
+                ).fetchall()
+            if rows:
+                vectors = np.frombuffer(b"".join(row[3] for row in rows), dtype="float32").reshape(-1, dim)
+                self.index.add(np.ascontiguousarray(vectors))
+                self.entries = [(row[0], row[1], row[2]) for row in rows]
+            logger.info(f"Loaded semantic cache with {len(self.entries)} entries.")
+        except Exception as e:
+            logger.error(f"Failed to load semantic cache: {e}")
+            self.index = faiss.IndexFlatIP(dim)
+            self.entries = []
+
+    def _lookup_rowid(self, rowid: int) -> Optional[dict]:
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute('SELECT answer FROM answer_cache WHERE rowid = ?', (rowid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _lookup_exact(self, query: str, device: str, os_name: str) -> Optional[dict]:
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                'SELECT answer FROM answer_cache WHERE query = ? AND device = ? AND os = ? LIMIT 1',
+                (query, device, os_name)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def search(self, query: str, device: str, os_name: str) -> Optional[dict]:
+        """Returns the cached answer for the closest matching query on the same device/OS, if any."""
+        try:
+            exact = self._lookup_exact(query, device, os_name)
+            if exact is not None:
+                logger.info(f"Exact cache hit for query: {query}")
+                return exact
+
+            q_emb = self._embed(query)
+            with self._lock:
+                self._ensure_loaded(q_emb.shape[1])
+                if not self.entries:
+                    return None
+                scores, indices = self.index.search(q_emb, min(self.candidates, len(self.entries)))
+                for score, idx in zip(scores[0], indices[0]):
+                    if idx < 0 or score < self.threshold:
+                        break
+                    rowid, entry_device, entry_os = self.entries[idx]
+                    if entry_device == device and entry_os == os_name:
+                        logger.info(f"Semantic cache hit (cosine={score:.3f}) for query: {query}")
+                        return self._lookup_rowid(rowid)
+            return None
+        except Exception as e:
+            logger.error(f"Semantic cache lookup failed: {e}")
+            return None
+
+    def add(self, query: str, device: str, os_name: str, answer: dict):
+        try:
+            q_emb = self._embed(query)
+            answer_json = json.dumps(answer, ensure_ascii=False)
+            with self._lock:
+                self._ensure_loaded(q_emb.shape[1])
+                with sqlite3.connect(self.db_path) as conn:
+                    row = conn.execute(
+                        'SELECT rowid FROM answer_cache WHERE query = ? AND device = ? AND os = ?',
+                        (query, device, os_name)
+                    ).fetchone()
+                    if row:
+                        # Same key: refresh the answer in place; its vector is already indexed
+                        conn.execute('UPDATE answer_cache SET answer = ? WHERE rowid = ?', (answer_json, row[0]))
+                        return
+                    cursor = conn.execute('''
+                        INSERT INTO answer_cache (query, device, os, answer, embedding)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (query, device, os_name, answer_json, q_emb.tobytes()))
+                self.index.add(q_emb)
+                self.entries.append((cursor.lastrowid, device, os_name))
+        except Exception as e:
+            logger.error(f"Failed to add entry to semantic cache: {e}")
+
+    async def search_async(self, query: str, device: str, os_name: str) -> Optional[dict]:
+        return await asyncio.to_thread(self.search, query, device, os_name)
+
+    async def add_async(self, query: str, device: str, os_name: str, answer: dict):
+        await asyncio.to_thread(self.add, query, device, os_name, answer)
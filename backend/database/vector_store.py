@@ -1,89 +1,332 @@
 # backend/database/vector_store.py
 import os
 import json
+import hashlib
 import logging
 import asyncio
+import atexit
+import threading
+from functools import lru_cache
 import numpy as np
 import faiss
-from typing import List, Tuple, Optional
+import torch
+from typing import Iterable, List, Tuple, Optional
 from sentence_transformers import SentenceTransformer, CrossEncoder
 
 logger = logging.getLogger("techmate.vector_store")
 
+# Index tiers by corpus size: FP32 flat -> INT8 scalar-quantized flat -> IVFPQ.
+# Below SQ8_MIN_VECTORS the SQ ranges would be trained on too few samples.
+SQ8_MIN_VECTORS = 1_000
+IVFPQ_MIN_VECTORS = 10_000
+IVFPQ_M = 16       # PQ sub-quantizers (384-dim MiniLM -> 24 dims per sub-vector)
+IVFPQ_NBITS = 8
+IVF_NPROBE = 8
+# Binary (Hamming) search is coarse, so over-fetch candidates for the CrossEncoder to re-rank
+BINARY_OVERSAMPLE = 4
+ENCODE_BATCH_SIZE = 64
+
+# Use every core for FAISS search and the PyTorch CrossEncoder (override with TECHMATE_NUM_THREADS)
+NUM_THREADS = int(os.getenv("TECHMATE_NUM_THREADS", os.cpu_count() or 1))
+faiss.omp_set_num_threads(NUM_THREADS)
+torch.set_num_threads(NUM_THREADS)
+
+# Opt-in multi-process encoding for large ingests (EMBEDDING_WORKERS=N CPU worker processes).
+# A single process already uses every core via intra-op threads, so the pool only pays off
+# for big batches; small Tavily batches keep the in-process path. Workers receive a pickled
+# copy of the model, which ONNX Runtime sessions do not support, so this needs the torch backend.
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "0"))
+MULTI_PROCESS_MIN_TEXTS = 256
+
+# The bi-encoder runs on ONNX Runtime with the INT8 dynamically-quantized weights shipped in the
+# all-MiniLM-L6-v2 hub repo; set EMBEDDING_BACKEND=torch to use PyTorch eager instead.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+
+# Models are cached per process so every VectorStore (and reload) shares one copy
+@lru_cache(maxsize=None)
+def load_embedding_model(name: str = "all-MiniLM-L6-v2") -> SentenceTransformer:
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            logger.info(f"Loading SentenceTransformer (Retrieval) model on ONNX Runtime ({EMBEDDING_ONNX_FILE})...")
+            return SentenceTransformer(name, backend="onnx", model_kwargs={"file_name": EMBEDDING_ONNX_FILE})
+        except Exception as e:
+            logger.warning(f"ONNX embedding backend unavailable, falling back to PyTorch: {e}")
+    logger.info("Loading SentenceTransformer (Retrieval) model...")
+    return SentenceTransformer(name)
+
+@lru_cache(maxsize=None)
+def load_reranker_model(name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2") -> CrossEncoder:
+    logger.info("Loading CrossEncoder (Re-ranking) model...")
+    return CrossEncoder(name)
+
 class VectorStore:
-    def __init__(self, index_path: str = "data/faiss.index", chunks_path: str = "data/faiss_chunks.json"):
+    def __init__(self, index_path: str = "data/faiss.index", chunks_path: str = "data/faiss_chunks.json",
+                 sources_path: str = "data/faiss_sources.json", binary: bool = False):
         self.index_path = index_path
         self.chunks_path = chunks_path
+        self.sources_path = sources_path
+        # Stores sign bits of each embedding in an IndexBinaryFlat (32x smaller, popcount search)
+        self.binary = binary
         self.vector_index = None
         self.chunk_texts: List[str] = []
+        # Set view of chunk_texts so re-scraped paragraphs are never encoded or indexed twice
+        self._indexed_chunks: set = set()
+        # Keys of (url, content) pairs already embedded, so re-scraped pages skip encode
+        self.source_keys: set = set()
+        # Guards the in-memory index/chunks; held only briefly so searches never wait on disk I/O
+        self._lock = threading.RLock()
+        # Serializes background saves so an older snapshot can never overwrite a newer one
+        self._save_lock = threading.Lock()
+        # Set when a saved index could not be rebuilt; the store then serves it as-is and never writes
+        self.read_only = False
         
         # Lazy loaders for our models
         self._embedding_model = None 
         self._reranker_model = None
+        self._encode_pool = None
+        self._pool_disabled = False
+        self._pool_lock = threading.Lock()
         self._load_from_disk()
 
     @property
     def model(self):
         """Lazy loader for the fast Bi-encoder (Retrieval)."""
         if self._embedding_model is None:
-            logger.info("Loading SentenceTransformer (Retrieval) model...")
-            self._embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+            self._embedding_model = load_embedding_model()
         return self._embedding_model
 
     @property
     def reranker(self):
         """Lazy loader for the accurate Cross-Encoder (Re-ranking)."""
         if self._reranker_model is None:
-            logger.info("Loading CrossEncoder (Re-ranking) model...")
             # ms-marco is specifically trained for search and Q&A relevance
-            self._reranker_model = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
+            self._reranker_model = load_reranker_model()
         return self._reranker_model
 
+    @property
+    def encode_pool(self):
+        """Lazily starts the multi-process encode pool (None if unavailable); stopped at interpreter exit."""
+        with self._pool_lock:
+            if self._encode_pool is None and not self._pool_disabled:
+                if getattr(self.model, "backend", "torch") != "torch":
+                    logger.warning(f"EMBEDDING_WORKERS needs the torch backend (loaded: {self.model.backend}); encoding in-process.")
+                    self._pool_disabled = True
+                    return None
+                try:
+                    logger.info(f"Starting {EMBEDDING_WORKERS} embedding worker processes...")
+                    self._encode_pool = self.model.start_multi_process_pool(target_devices=["cpu"] * EMBEDDING_WORKERS)
+                    atexit.register(self.model.stop_multi_process_pool, self._encode_pool)
+                except Exception as e:
+                    logger.error(f"Failed to start embedding worker pool; encoding in-process: {e}")
+                    self._pool_disabled = True
+            return self._encode_pool
+
     def _load_from_disk(self):
         if os.path.exists(self.index_path) and os.path.exists(self.chunks_path):
             try:
-                self.vector_index = faiss.read_index(self.index_path)
+                if self.binary:
+                    self.vector_index = faiss.read_index_binary(self.index_path)
+                else:
+                    self.vector_index = faiss.read_index(self.index_path)
                 with open(self.chunks_path, "r", encoding="utf-8") as f:
                     self.chunk_texts = json.load(f)
+                self._indexed_chunks = set(self.chunk_texts)
+                if os.path.exists(self.sources_path):
+                    with open(self.sources_path, "r", encoding="utf-8") as f:
+                        self.source_keys = set(json.load(f))
                 logger.info(f"Loaded FAISS index with {len(self.chunk_texts)} chunks.")
+                if self.vector_index.ntotal != len(self.chunk_texts):
+                    # Save was cut off between the index and chunk files. The newer index may have been
+                    # deduped by a rebuild, so ids cannot be mapped onto the old chunk list by position.
+                    logger.warning(
+                        f"FAISS index ({self.vector_index.ntotal}) and chunk list ({len(self.chunk_texts)}) "
+                        "out of sync; rebuilding from saved chunks."
+                    )
+                    self._reindex_chunks()
+                # elif: a successful repair above already rebuilt as inner product, and a failed one
+                # (read_only) would fail the same way again
+                elif not self.binary and self.vector_index.metric_type != faiss.METRIC_INNER_PRODUCT:
+                    self._reindex_chunks()
             except Exception as e:
                 logger.error(f"Failed to load FAISS index: {e}")
                 self.vector_index = None
                 self.chunk_texts = []
+                self._indexed_chunks = set()
+                self.source_keys = set()
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        """Writes to a temp file and renames it over path, so readers never see a partial file."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
 
     def save_to_disk(self):
-        if self.vector_index is None:
+        if self.read_only:
             return
-        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
-        try:
-            faiss.write_index(self.vector_index, self.index_path)
-            with open(self.chunks_path, "w", encoding="utf-8") as f:
-                json.dump(self.chunk_texts, f, ensure_ascii=False, indent=2)
-            logger.info("Successfully saved FAISS index to disk.")
-        except Exception as e:
-            logger.error(f"Failed to save FAISS index: {e}")
+        with self._save_lock:
+            # Snapshot under the lock, then write without it so searches are not blocked on disk
+            with self._lock:
+                if self.vector_index is None:
+                    return
+                if self.binary:
+                    index_bytes = faiss.serialize_index_binary(self.vector_index).tobytes()
+                else:
+                    index_bytes = faiss.serialize_index(self.vector_index).tobytes()
+                chunk_texts = list(self.chunk_texts)
+                source_keys = sorted(self.source_keys)
+
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            try:
+                # Index first: if we are cut off, the loader sees index/chunk counts disagree and rebuilds
+                self._write_atomic(self.index_path, index_bytes)
+                self._write_atomic(self.chunks_path, json.dumps(chunk_texts, ensure_ascii=False, indent=2).encode("utf-8"))
+                self._write_atomic(self.sources_path, json.dumps(source_keys).encode("utf-8"))
+                logger.info("Successfully saved FAISS index to disk.")
+            except Exception as e:
+                logger.error(f"Failed to save FAISS index: {e}")
+
+    async def save_to_disk_async(self):
+        await asyncio.to_thread(self.save_to_disk)
+
+    @staticmethod
+    def source_key(url: str, content: str) -> str:
+        """Identifies a scraped page by its URL and a hash of its extracted text."""
+        return hashlib.sha1(f"{url}\0{content}".encode("utf-8")).hexdigest()
+
+    def has_source(self, key: str) -> bool:
+        return key in self.source_keys
+
+    def unindexed(self, chunks: List[str]) -> List[str]:
+        """Filters chunks down to those not yet in the index (order preserved)."""
+        return [c for c in chunks if c not in self._indexed_chunks]
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embeds texts as a 2-D float32 matrix (one row per text)."""
+        # SentenceTransformer.encode already sorts inputs by length before batching and
+        # restores the original order, so callers can pass chunks in arrival order.
+        # Unit-normalized so inner product == cosine, which is what MiniLM is trained for
+        # pool=None encodes in-process; a pool fans the batch out to the worker processes
+        pool = self.encode_pool if EMBEDDING_WORKERS > 1 and len(texts) >= MULTI_PROCESS_MIN_TEXTS else None
+        embeddings = self.model.encode(
+            texts, pool=pool, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True,
+            normalize_embeddings=True, show_progress_bar=False
+        )
+        # FAISS needs C-contiguous float32; this is a no-op when encode already returned that
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            embeddings = np.expand_dims(embeddings, axis=0)
+        return embeddings
 
-    def add_texts(self, chunks: List[str], persist: bool = True):
-        if not chunks: return
+    def add_texts(self, chunks: List[str], persist: bool = True, source_keys: Optional[Iterable[str]] = None):
+        if self.read_only:
+            logger.warning("Vector store is read-only after a failed rebuild; skipping add.")
+            return
+        # Only encode chunks not already in the index (the index grows incrementally across queries)
+        chunks = [c for c in dict.fromkeys(chunks) if c not in self._indexed_chunks]
+        if not chunks:
+            if source_keys:
+                with self._lock:
+                    self.source_keys.update(source_keys)
+            return
         try:
-            embeddings = self.model.encode(chunks, convert_to_numpy=True, show_progress_bar=False)
-            embeddings = np.asarray(embeddings).astype("float32")
-            if embeddings.ndim == 1:
-                embeddings = np.expand_dims(embeddings, axis=0)
+            embeddings = self.encode(chunks)
             
             dim = embeddings.shape[1]
-            if self.vector_index is None:
-                self.vector_index = faiss.IndexFlatL2(dim)
-                logger.info(f"Created new FAISS index (dim={dim}).")
+            with self._lock:
+                # A concurrent add may have indexed some of these while we were encoding
+                keep = [i for i, c in enumerate(chunks) if c not in self._indexed_chunks]
+                if len(keep) < len(chunks):
+                    chunks, embeddings = [chunks[i] for i in keep], embeddings[keep]
+                    if not chunks:
+                        if source_keys: self.source_keys.update(source_keys)
+                        return
+
+                if self.vector_index is None:
+                    self.vector_index = self._new_index(dim)
+                    logger.info(f"Created new FAISS index (dim={dim}, binary={self.binary}).")
 
-            self.vector_index.add(embeddings)
-            self.chunk_texts.extend(chunks)
+                self.vector_index = self._add_to_index(self.vector_index, embeddings)
+                self.chunk_texts.extend(chunks)
+                self._indexed_chunks.update(chunks)
+                if source_keys: self.source_keys.update(source_keys)
             if persist: self.save_to_disk()
         except Exception as e:
             logger.error(f"Failed to add texts to vector store: {e}")
 
-    async def add_texts_async(self, chunks: List[str], persist: bool = True):
-        await asyncio.to_thread(self.add_texts, chunks, persist)
+    def _reindex_chunks(self):
+        """Re-embeds the stored chunks into a fresh index (migrations and repairs of saved indexes).
+
+        The new index is built on the side and only swapped in once it is complete; if that fails,
+        the loaded index and chunks are kept and the store becomes read-only so the saved corpus
+        is never overwritten.
+        """
+        chunks = list(dict.fromkeys(self.chunk_texts))
+        logger.info(f"Rebuilding FAISS index over {len(chunks)} chunks...")
+        try:
+            embeddings = self.encode(chunks)
+            index = self._add_to_index(self._new_index(embeddings.shape[1]), embeddings)
+        except Exception as e:
+            logger.error(f"Failed to rebuild FAISS index; serving the saved index read-only: {e}")
+            self.read_only = True
+            return
+
+        with self._lock:
+            self.vector_index = index
+            self.chunk_texts = chunks
+            self._indexed_chunks = set(chunks)
+        self.save_to_disk()
+
+    def _new_index(self, dim: int):
+        if self.binary:
+            return faiss.IndexBinaryFlat(dim)
+        return faiss.IndexFlatIP(dim)
+
+    def _add_to_index(self, index, embeddings: np.ndarray):
+        """Adds embeddings to index and returns it, possibly replaced by a higher tier."""
+        if self.binary:
+            index.add(self._pack_bits(embeddings))
+            return index
+        index.add(embeddings)
+        return self._upgrade_index(index)
+
+    @staticmethod
+    def _pack_bits(embeddings: np.ndarray) -> np.ndarray:
+        """Binarizes embeddings to one sign bit per dimension, packed 8 dims per byte."""
+        return np.packbits(embeddings > 0, axis=1)
+
+    @staticmethod
+    def _upgrade_index(index):
+        """Moves the index up a tier (flat -> SQ8 -> IVFPQ) once the corpus is large enough to train it."""
+        n, dim = index.ntotal, index.d
+
+        if isinstance(index, faiss.IndexFlat) and n >= SQ8_MIN_VECTORS and n < IVFPQ_MIN_VECTORS:
+            vectors = index.reconstruct_n(0, n)
+            # Vectors added after training are clamped to the trained per-dimension ranges
+            new_index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            new_index.train(vectors)
+            new_index.add(vectors)
+            logger.info(f"Upgraded FAISS index to INT8 scalar quantizer (vectors={n}).")
+            return new_index
+
+        if isinstance(index, (faiss.IndexFlat, faiss.IndexScalarQuantizer)) and n >= IVFPQ_MIN_VECTORS:
+            vectors = index.reconstruct_n(0, n)
+            nlist = max(4, int(np.sqrt(n)))
+
+            quantizer = faiss.IndexFlatIP(dim)
+            new_index = faiss.IndexIVFPQ(quantizer, dim, nlist, IVFPQ_M, IVFPQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+            new_index.train(vectors)
+            new_index.add(vectors)
+            new_index.nprobe = IVF_NPROBE
+            logger.info(f"Upgraded FAISS index to IVFPQ (nlist={nlist}, vectors={n}).")
+            return new_index
+
+        return index
+
+    async def add_texts_async(self, chunks: List[str], persist: bool = True, source_keys: Optional[Iterable[str]] = None):
+        await asyncio.to_thread(self.add_texts, chunks, persist, source_keys)
 
     def search_and_rerank(self, query: str, retrieve_top_k: int = 10, final_top_k: int = 3) -> List[str]:
         """Retrieves a wide net of chunks, then uses a CrossEncoder to keep only the absolute best."""
@@ -92,16 +335,20 @@ class VectorStore:
 
         try:
             # 1. RETRIEVE: Get top 10 fast matches
-            q_emb = self.model.encode([query], convert_to_numpy=True)
-            q_emb = np.asarray(q_emb).astype("float32")
-            if q_emb.ndim == 1: q_emb = np.expand_dims(q_emb, axis=0)
+            q_emb = self.encode([query])
 
-            distances, indices = self.vector_index.search(q_emb, retrieve_top_k)
-            
-            retrieved_chunks = []
-            for idx in indices[0]:
-                if 0 <= idx < len(self.chunk_texts):
-                    retrieved_chunks.append(self.chunk_texts[idx])
+            with self._lock:
+                if self.binary:
+                    distances, indices = self.vector_index.search(self._pack_bits(q_emb), retrieve_top_k * BINARY_OVERSAMPLE)
+                else:
+                    if isinstance(self.vector_index, faiss.IndexIVF):
+                        self.vector_index.nprobe = IVF_NPROBE
+                    distances, indices = self.vector_index.search(q_emb, retrieve_top_k)
+
+                # FAISS pads with -1 when fewer than k hits exist; mask them out in one vectorized pass
+                ids = indices[0]
+                ids = ids[(ids >= 0) & (ids < len(self.chunk_texts))]
+                retrieved_chunks = [self.chunk_texts[i] for i in ids]
 
             if not retrieved_chunks:
                 return []
@@ -111,12 +358,9 @@ class VectorStore:
             cross_inp = [[query, chunk] for chunk in retrieved_chunks]
             scores = self.reranker.predict(cross_inp)
 
-            # Sort chunks by their CrossEncoder score (highest first)
-            scored_chunks = list(zip(scores, retrieved_chunks))
-            scored_chunks.sort(key=lambda x: x[0], reverse=True)
-
-            # Return only the top N chunks
-            best_chunks = [chunk for score, chunk in scored_chunks[:final_top_k]]
+            # Return only the top N chunks by CrossEncoder score (highest first)
+            order = np.argsort(-np.asarray(scores))[:final_top_k]
+            best_chunks = [retrieved_chunks[i] for i in order]
             logger.info(f"Re-ranked top {retrieve_top_k} down to {final_top_k} high-quality chunks.")
             return best_chunks
 
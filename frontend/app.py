@@ -6,6 +6,18 @@ import os
 
 # Configuration
 API_URL = os.getenv("API_URL", "http://backend:8000/api/chat")
+# Plan generation runs a web search plus an LLM call, so allow well beyond a normal page load
+API_TIMEOUT_SECONDS = 120
+
+def get_http_session() -> requests.Session:
+    """Keep-alive connection to the backend, reused across reruns of this user's session.
+
+    Kept per user in session_state: each Streamlit session runs on its own thread and
+    requests.Session is not documented as thread-safe.
+    """
+    if "http_session" not in st.session_state:
+        st.session_state.http_session = requests.Session()
+    return st.session_state.http_session
 
 # 1. Page Configuration
 st.set_page_config(
@@ -130,7 +142,7 @@ if prompt := st.chat_input("Describe your tech issue here..."):
                     "os_name": os_name
                 }
                 
-                response = requests.post(API_URL, json=payload)
+                response = get_http_session().post(API_URL, json=payload, timeout=API_TIMEOUT_SECONDS)
                 
                 if response.status_code == 200:
                     reply = response.json().get("reply", "I encountered an error formatting the response.")
@@ -139,5 +151,7 @@ if prompt := st.chat_input("Describe your tech issue here..."):
                 else:
                     st.error(f"⚠️ Backend API Error (Status {response.status_code})")
                     
+            except requests.exceptions.Timeout:
+                st.error(f"⏳ The backend took longer than {API_TIMEOUT_SECONDS}s to respond. Please try again.")
             except requests.exceptions.ConnectionError:
                 st.error(f"🔌 Failed to connect to the backend at `{API_URL}`. Make sure your Docker container or FastAPI server is running.")
\ No newline at end of file